@@ -9,19 +9,26 @@ Example usage:
     python3 get-repos.py
 """
 
+import io
+import os
 import sys
 import argparse
+import csv
 import calendar
 import time
+import random
 import signal
 import logging
-from typing import Union
-import numpy as np
-import pandas as pd
-from github import Github, GithubException, Repository
-from github.GithubObject import NotSet
-from github.GithubException import RateLimitExceededException
-from github.PaginatedList import PaginatedList
+import queue
+import threading
+from typing import List, TextIO, Union
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 def signal_handler(sig, frame):
@@ -32,7 +39,7 @@ def signal_handler(sig, frame):
     sys.exit(0)
 
 
-PROPERTIES = [
+PROPERTIES = (
     "allow_auto_merge",
     "allow_forking",
     "allow_merge_commit",
@@ -118,98 +125,282 @@ PROPERTIES = [
     "visibility",
     "watchers",
     "watchers_count",
-]
+)
+ID_INDEX = PROPERTIES.index("id")
 
+API_URL = "https://api.github.com"
+# Seconds to wait for the API before giving up on a request.
+REQUEST_TIMEOUT = 60
+# Retries for connection errors, timeouts and 5xx responses, sleeping
+# REQUEST_BACKOFF * 2**retry seconds (at most 2 minutes) in between.
+REQUEST_RETRIES = 10
+REQUEST_BACKOFF = 1.0
+# Pages of repositories waiting to be written before fetching blocks.
+WRITE_QUEUE_SIZE = 16
 
-def get_max_id(filename: str) -> Union[int, NotSet]:
-    """Returns the maximum id from the dataframe.
+
+# Exponential backoff (in seconds) for rate limits that do not say when to
+# retry, such as the secondary rate limit.
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+BACKOFF_JITTER = 0.5
+
+
+def get_backoff_time(headers: dict, attempt: int) -> float:
+    """Returns how many seconds to sleep after hitting the rate limit.
+    Honors the Retry-After header if present. If the primary rate limit is
+    used up, sleeps until it resets. Otherwise backs off exponentially (with
+    jitter) based on the number of consecutive attempts.
+    """
+    headers = headers or {}
+    retry_after = headers.get("retry-after")
+    if retry_after is not None:
+        return float(retry_after)
+    reset = headers.get("x-ratelimit-reset")
+    if headers.get("x-ratelimit-remaining") == "0" and reset is not None:
+        # Add 5 seconds to be sure the rate limit has been reset.
+        return max(0, int(reset) - calendar.timegm(time.gmtime()) + 5)
+    # Cap the exponent too, so a long streak of attempts can't overflow.
+    backoff = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** min(attempt, 5))
+    return backoff * (1 + random.uniform(0, BACKOFF_JITTER))
+
+
+def is_rate_limited(response: requests.Response) -> bool:
+    """Returns True if the request was rejected by a rate limit.
+    GitHub answers with a 403 or 429 for both the primary and the secondary
+    rate limit.
+    """
+    if response.status_code not in (403, 429):
+        return False
+    return (
+        response.headers.get("x-ratelimit-remaining") == "0"
+        or "retry-after" in response.headers
+        or "rate limit" in response.text.lower()
+    )
+
+
+def get_throttle_time(remaining: int, reset_timestamp: int) -> float:
+    """Returns how many seconds to wait before the next request.
+    Spreads the remaining requests evenly over the time left until the rate
+    limit resets, instead of using them up and sleeping until the reset.
+    """
+    seconds_until_reset = reset_timestamp - calendar.timegm(time.gmtime())
+    return max(0, seconds_until_reset / max(remaining, 1))
+
+
+def parse_last_id(text: str) -> Union[int, None]:
+    """Returns the id of the last complete row in the CSV text, or None if no
+    row can be parsed.
+    """
+    try:
+        rows = list(csv.reader(io.StringIO(text)))
+    except csv.Error:
+        return None
+    # Skip rows cut off by an interrupted write.
+    for row in reversed(rows):
+        if len(row) != len(PROPERTIES):
+            continue
+        try:
+            return int(row[ID_INDEX])
+        except ValueError:
+            continue
+    return None
+
+
+def get_last_id(filename: str, tail_size: int = 1 << 16) -> Union[int, None]:
+    """Returns the id of the last complete row in the file, reading only its
+    tail. Repositories are appended in increasing id order, so that row holds
+    the maximum id. Returns None if the id can't be determined from the tail.
+    """
+    with open(filename, mode="rb") as f:
+        f.seek(0, os.SEEK_END)
+        start = max(0, f.tell() - tail_size)
+        f.seek(start)
+        # The seek may land in the middle of a character; it's dropped below.
+        tail = f.read().decode("utf-8", errors="ignore")
+    if start == 0:
+        return parse_last_id(tail)
+    # The seek may also land inside a quoted field spanning several lines.
+    # Right after a newline we are either at the start of a row or inside a
+    # quoted field, so parse the tail both ways and only trust the id if both
+    # agree.
+    newline = tail.find("\n")
+    if newline == -1:
+        return None
+    tail = tail[newline + 1 :]
+    last_id = parse_last_id(tail)
+    if last_id != parse_last_id('"' + tail):
+        return None
+    return last_id
+
+
+def get_max_id(filename: str) -> Union[int, None]:
+    """Returns the maximum id from the file.
     The is is used as a reference to start pulling repositories. See the
-    `since` parameter in PyGithub.Github.get_repos method.
-    If the id is NaN, returns NotSet.
+    `since` parameter of the GitHub /repositories endpoint.
+    If there is no id, returns None.
+    Tries the last row first and only parses the whole file if that fails.
     """
     with open(filename, mode="a", encoding="utf-8") as f:
-        # If the file isn't empty.
-        if f.tell() != 0:
-            df = pd.read_csv(filename, usecols=["id"])
-            df = pd.to_numeric(df.id, errors="coerce").astype(pd.Int64Dtype())
-            df = df.reset_index()
-        # File is empty, return NotSet.
-        else:
-            return NotSet
+        # File is empty, return None.
+        if f.tell() == 0:
+            return None
+    last_id = get_last_id(filename)
+    if last_id is not None:
+        return last_id
+    # pyarrow parses the file with multiple threads.
+    table = pacsv.read_csv(
+        filename,
+        parse_options=pacsv.ParseOptions(
+            # Descriptions can span several lines.
+            newlines_in_values=True,
+            # Skip rows cut off by an interrupted run.
+            invalid_row_handler=lambda row: "skip",
+        ),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=["id"], column_types={"id": pa.int64()}
+        ),
+    )
+    return pc.max(table["id"]).as_py()
+
+
+def save_repos_to_file(f: TextIO, repos: List[dict]):
+    """Appends the repositories (as decoded from the API) to an open CSV file.
+    Missing properties are written as empty fields.
+    """
+    # Write the whole page at once.
+    csv.writer(f).writerows([repo.get(prop) for prop in PROPERTIES] for repo in repos)
+
+
+def write_repos_from_queue(filename: str, pages: queue.Queue):
+    """Appends each page of repositories put on the queue to a file, until
+    None is put on the queue.
+    Creates the file if it does not exist. Meant to run on its own thread, so
+    the CSV is written while the next page is being fetched.
+    """
     try:
-        max_index = df.id.max()
-        if np.isnan(max_index):
-            return NotSet
-        return int(max_index)
-    except ValueError as e:
-        print(f"[-] Unknown index max: {df.id.max()}")
+        # Open the file once for the whole run. Rows are buffered in memory and
+        # flushed to disk once per page.
+        with open(
+            filename, mode="a", encoding="utf-8", newline="", buffering=1 << 20
+        ) as f:
+            # Only write the header when creating the file.
+            if f.tell() == 0:
+                csv.writer(f).writerow(PROPERTIES)
+            while True:
+                repos = pages.get()
+                if repos is None:
+                    return
+                save_repos_to_file(f=f, repos=repos)
+                # Whole pages only, so an interrupted run can resume from the
+                # file.
+                f.flush()
+    except OSError as e:
+        err_message = f"[-] Failed to write to {filename}: {e}"
+        # Log it to a file.
+        logging.error(err_message)
+        print(err_message)
         raise e
 
 
-def save_repos_to_file(filename: str, repos: PaginatedList):
-    """Appends the repositories to a file.
-    Creates the file if it does not exist.
+def put_page(
+    pages: queue.Queue,
+    repos: Union[List[dict], None],
+    writer_thread: threading.Thread,
+) -> bool:
+    """Puts a page (or the None sentinel) on the queue for the writer thread.
+    Returns False, instead of blocking forever on a full queue, if the writer
+    thread has died.
     """
-    with open(filename, mode="a", encoding="utf-8") as f:
+    while writer_thread.is_alive():
         try:
-            for repo in repos:
-                try:
-                    print(f"[+] Found repo {repo.name}.")
-                    # Create a dictionary entry for each repository.
-                    repo_dict = {}
-                    for prop in PROPERTIES:
-                        if hasattr(repo, prop):
-                            repo_dict[prop] = getattr(repo, prop)
-                    #  Ensure that ID is an integer.
-                    try:
-                        int(repo_dict["id"])
-                    except:
-                        continue
-                    df = pd.DataFrame(data=[repo_dict], columns=PROPERTIES)
-                    df.to_csv(f, header=f.tell() == 0, index=False)
-                except RateLimitExceededException as rate_limit_exceeded:
-                    raise rate_limit_exceeded
-                except GithubException as e:
-                    if hasattr(e, "data"):
-                        if hasattr(e.data, "message"):
-                            err_message = (
-                                f"[+] {repo.name}: {e.data.get('message')} skipping."
-                            )
-                            # Log it to a file.
-                            logging.error(err_message)
-                            print(err_message)
-                    else:
-                        raise e
-                    continue
-        except RateLimitExceededException as rate_limit_exceeded:
-            raise rate_limit_exceeded
-
-
-def get_repos_with_backoff(github: Github, save_results_to: str, since: int = NotSet):
+            pages.put(repos, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def get_repos_with_backoff(
+    session: requests.Session, save_results_to: str, since: Union[int, None] = None
+):
     """Gets all public repos from GitHub, starting from the given ID (since).
-    Since the API is rate limited, this function will back off (sleep) until
-    the rate limit has been reset.
+    Since the API is rate limited, this function paces its requests to last
+    until the rate limit resets (see `get_throttle_time`), and backs off
+    (sleeps) before retrying if it is exceeded anyway (see `get_backoff_time`).
+    The results are appended to `save_results_to` by a writer thread (see
+    `write_repos_from_queue`).
     """
-    print(f"[+] Getting repositories since: {since}")
+    pages = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    writer_thread = threading.Thread(
+        target=write_repos_from_queue, args=(save_results_to, pages), daemon=True
+    )
+    writer_thread.start()
     try:
-        repos = github.get_repos(since=since, visibility="public")
-        save_repos_to_file(filename=save_results_to, repos=repos)
+        # Consecutive rate limited attempts, reset after every successful page.
+        attempt = 0
+        while True:
+            print(f"[+] Getting repositories since: {since}")
+            # The endpoint paginates by `since` only, one page per request.
+            try:
+                response = session.get(
+                    f"{API_URL}/repositories",
+                    params={} if since is None else {"since": since},
+                    timeout=REQUEST_TIMEOUT,
+                )
+            except requests.RequestException as e:
+                err_message = f"[-] Failed to get repositories since {since}: {e}"
+                # Log it to a file.
+                logging.error(err_message)
+                print(err_message)
+                raise e
+            if is_rate_limited(response):
+                sleep_time = get_backoff_time(headers=response.headers, attempt=attempt)
+                attempt += 1
 
-    except RateLimitExceededException:
-        core_rate_limit = github.get_rate_limit().core
-        reset_timestamp = calendar.timegm(core_rate_limit.reset.timetuple())
-        # Add 5 seconds to be sure the rate limit has been reset.
-        sleep_time = reset_timestamp - calendar.timegm(time.gmtime()) + 5
+                print(
+                    f"[+] Rate limit exceeded, backing off for "
+                    f"{sleep_time:.0f} seconds."
+                )
+                time.sleep(sleep_time)
+                continue
+            if not response.ok:
+                err_message = (
+                    f"[-] Failed to get repositories since {since}: "
+                    f"{response.status_code} {response.text}"
+                )
+                # Log it to a file.
+                logging.error(err_message)
+                print(err_message)
+            response.raise_for_status()
 
-        print(f"[+] Rate limit exceeded, backing off for {sleep_time} seconds.")
-        # Sleep until the rate limit resets.
-        time.sleep(sleep_time)
+            repos = orjson.loads(response.content)
+            if not repos:
+                print("[+] No more repositories.")
+                return
+            #  Ensure that ID is an integer, filtering the whole page at once.
+            repos = [repo for repo in repos if isinstance(repo.get("id"), int)]
+            if not repos:
+                # The cursor can't advance, so the same page would be fetched
+                # forever.
+                raise ValueError(f"No repository with an integer id after {since}.")
+            for repo in repos:
+                print(f"[+] Found repo {repo.get('name')}.")
+            if not put_page(pages=pages, repos=repos, writer_thread=writer_thread):
+                raise RuntimeError(f"Stopped writing to {save_results_to}.")
+            since = max([0 if since is None else since] + [r["id"] for r in repos])
+            attempt = 0
 
-    # Get the last ID to call this function again.
-    last_id = get_max_id(filename=save_results_to)
-    get_repos_with_backoff(
-        github=github, save_results_to=save_results_to, since=last_id
-    )
+            time.sleep(
+                get_throttle_time(
+                    remaining=int(response.headers.get("x-ratelimit-remaining", 0)),
+                    reset_timestamp=int(response.headers.get("x-ratelimit-reset", 0)),
+                )
+            )
+    finally:
+        # Let the writer finish the queued pages before exiting.
+        if put_page(pages=pages, repos=None, writer_thread=writer_thread):
+            writer_thread.join()
 
 
 if __name__ == "__main__":
@@ -238,23 +429,43 @@ if __name__ == "__main__":
     if not api_token:
         print("[+] No API token provided, running script without authentication.")
 
-    g = Github(login_or_token=api_token)
+    session = requests.Session()
+    session.headers["Accept"] = "application/vnd.github+json"
+    # Don't let a transient server or network error end a run that takes weeks.
+    # Rate limits (403/429) are handled by `get_repos_with_backoff` instead.
+    retries = Retry(
+        total=REQUEST_RETRIES,
+        backoff_factor=REQUEST_BACKOFF,
+        status_forcelist=range(500, 600),
+        allowed_methods={"GET"},
+        # Hand rate limits, and the last failed response, back to the caller.
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    )
+    session.mount("https://", HTTPAdapter(max_retries=retries))
+    if api_token:
+        session.headers["Authorization"] = f"token {api_token}"
 
-    try:
+    # One request for both numbers, rather than one for each.
+    response = session.get(f"{API_URL}/rate_limit", timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    core_rate_limit = response.json()["resources"]["core"]
+    user = session.get(f"{API_URL}/user", timeout=REQUEST_TIMEOUT)
+    if user.ok:
         print(
-            f"[+] Successfully authenticated as {g.get_user().login}, "
-            f"rate limit is: {g.get_rate_limit().core.remaining} out "
-            f"of {g.get_rate_limit().core.limit}."
+            f"[+] Successfully authenticated as {user.json()['login']}, "
+            f"rate limit is: {core_rate_limit['remaining']} out "
+            f"of {core_rate_limit['limit']}."
         )
-    except GithubException:
+    else:
         print(
             f"[+] Did not authenticate, but successfully connected to Github. "
-            f"Rate limit is: {g.get_rate_limit().core.remaining} out "
-            f"of {g.get_rate_limit().core.limit}."
+            f"Rate limit is: {core_rate_limit['remaining']} out "
+            f"of {core_rate_limit['limit']}."
         )
-    # Check the CSV for the last seen index. The get_repo() uses the index as
+    # Check the CSV for the last seen index. /repositories uses the index as
     # the "since" parameter, so we can continue from where we left off.
     # Create the file if it does not exist.
     last_id = get_max_id(filename=filename)
 
-    get_repos_with_backoff(github=g, save_results_to=filename, since=last_id)
+    get_repos_with_backoff(session=session, save_results_to=filename, since=last_id)